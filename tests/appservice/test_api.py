@@ -11,9 +11,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Any, List, Mapping, Sequence, Union
-from unittest.mock import Mock
+from types import MappingProxyType
+from typing import Any, Awaitable, List, Mapping, Sequence, Tuple, TypeVar, Union
 
+from twisted.internet.defer import Deferred, ensureDeferred
 from twisted.test.proto_helpers import MemoryReactor
 
 from synapse.api.errors import HttpResponseException
@@ -24,108 +25,148 @@ from synapse.util import Clock
 
 from tests import unittest
 
+TV = TypeVar("TV")
+
 PROTOCOL = "myproto"
 TOKEN = "myastoken"
 URL = "http://mytestservice"
 
-
-class ApplicationServiceApiTestCase(unittest.HomeserverTestCase):
-    def prepare(self, reactor: MemoryReactor, clock: Clock, hs: HomeServer) -> None:
-        self.api = hs.get_application_service_api()
-        self.service = ApplicationService(
-            id="unique_identifier",
-            sender="@as:test",
-            url=URL,
-            token="unused",
-            hs_token=TOKEN,
-        )
-
-    def test_query_3pe_authenticates_token(self) -> None:
-        """
-        Tests that 3pe queries to the appservice are authenticated
-        with the appservice's token.
-        """
-
-        SUCCESS_RESULT_USER = [
+SUCCESS_RESULT_USER = [
+    {
+        "protocol": PROTOCOL,
+        "userid": "@a:user",
+        "fields": {
+            "more": "fields",
+        },
+    }
+]
+SUCCESS_RESULT_LOCATION = [
+    {
+        "protocol": PROTOCOL,
+        "alias": "#a:room",
+        "fields": {
+            "more": "fields",
+        },
+    }
+]
+
+# What the code under test sends alongside every request. The header value
+# must stay a list to compare equal to what ApplicationServiceApi builds.
+EXPECTED_AUTH_HEADER = [f"Bearer {TOKEN}"]
+QUERY_ARGS = {b"some": [b"field"]}
+
+URL_USER = f"{URL}/_matrix/app/v1/thirdparty/user/{PROTOCOL}"
+URL_LOCATION = f"{URL}/_matrix/app/v1/thirdparty/location/{PROTOCOL}"
+FALLBACK_URL_USER = f"{URL}/_matrix/app/unstable/thirdparty/user/{PROTOCOL}"
+
+FOUND_KEYS = [
+    ("@alice:example.org", "DEVICE_1", "signed_curve25519", 1),
+    ("@alice:example.org", "DEVICE_2", "signed_curve25519", 1),
+]
+MISSING_KEYS = [
+    # Known user, known device, missing algorithm.
+    ("@alice:example.org", "DEVICE_2", "xyz", 1),
+    # Known user, missing device.
+    ("@alice:example.org", "DEVICE_3", "signed_curve25519", 1),
+    # Unknown user.
+    ("@bob:example.org", "DEVICE_4", "signed_curve25519", 1),
+]
+# Concatenated once at import so the test doesn't rebuild the request list.
+ALL_KEYS = FOUND_KEYS + MISSING_KEYS
+
+# A read-only view of the /keys/claim response, built once at import. The
+# proxies compare equal to plain dicts, so assertions against it still work.
+CLAIM_KEYS_RESPONSE: Mapping[str, Any] = MappingProxyType(
+    {
+        "@alice:example.org": MappingProxyType(
             {
-                "protocol": PROTOCOL,
-                "userid": "@a:user",
-                "fields": {
-                    "more": "fields",
-                },
+                "DEVICE_1": MappingProxyType(
+                    {
+                        "signed_curve25519:AAAAHg": {
+                            # We don't really care about the content of the keys,
+                            # they get passed back transparently.
+                        },
+                        "signed_curve25519:BBBBHg": {},
+                    }
+                ),
+                "DEVICE_2": MappingProxyType({"signed_curve25519:CCCCHg": {}}),
             }
-        ]
-        SUCCESS_RESULT_LOCATION = [
-            {
-                "protocol": PROTOCOL,
-                "alias": "#a:room",
-                "fields": {
-                    "more": "fields",
-                },
-            }
-        ]
-
-        URL_USER = f"{URL}/_matrix/app/v1/thirdparty/user/{PROTOCOL}"
-        URL_LOCATION = f"{URL}/_matrix/app/v1/thirdparty/location/{PROTOCOL}"
+        ),
+    }
+)
 
-        self.request_url = None
 
-        async def get_json(
-            url: str,
-            args: Mapping[Any, Any],
-            headers: Mapping[Union[str, bytes], Sequence[Union[str, bytes]]],
-        ) -> List[JsonDict]:
-            # Ensure the access token is passed as both a header and query arg.
-            if not headers.get("Authorization") or not args.get(b"access_token"):
-                raise RuntimeError("Access token not provided")
+class ApplicationServiceApiTestCase(unittest.HomeserverTestCase):
+    # The service is pure configuration, so a single instance can be shared by
+    # every test method. (It is built in the class body rather than in
+    # setUpClass as trial does not run setUpClass.)
+    service = ApplicationService(
+        id="unique_identifier",
+        sender="@as:test",
+        url=URL,
+        token="unused",
+        hs_token=TOKEN,
+    )
 
-            self.assertEqual(headers.get("Authorization"), [f"Bearer {TOKEN}"])
-            self.assertEqual(args.get(b"access_token"), TOKEN)
-            self.request_url = url
-            if url == URL_USER:
-                return SUCCESS_RESULT_USER
-            elif url == URL_LOCATION:
-                return SUCCESS_RESULT_LOCATION
-            else:
-                raise RuntimeError(
-                    "URL provided was invalid. This should never be seen."
-                )
+    def prepare(self, reactor: MemoryReactor, clock: Clock, hs: HomeServer) -> None:
+        self.api = hs.get_application_service_api()
 
-        # We assign to a method, which mypy doesn't like.
-        self.api.get_json = Mock(side_effect=get_json)  # type: ignore[assignment]
+    def _run(self, awaitable: Awaitable[TV]) -> TV:
+        """Synchronously unwrap an awaitable whose awaits never reach the reactor.
 
-        result = self.get_success(
-            self.api.query_3pe(self.service, "user", PROTOCOL, {b"some": [b"field"]})
-        )
-        self.assertEqual(self.request_url, URL_USER)
-        self.assertEqual(result, SUCCESS_RESULT_USER)
-        result = self.get_success(
-            self.api.query_3pe(
-                self.service, "location", PROTOCOL, {b"some": [b"field"]}
-            )
-        )
-        self.assertEqual(self.request_url, URL_LOCATION)
-        self.assertEqual(result, SUCCESS_RESULT_LOCATION)
+        The stubs used in these tests return immediately, so the Deferred has
+        already fired by the time we look at it; this skips the per-call
+        reactor pumping that get_success does.
+        """
+        deferred: Deferred[TV] = ensureDeferred(awaitable)  # type: ignore[arg-type]
+        return self.successResultOf(deferred)
 
-    def test_fallback(self) -> None:
+    def test_query_3pe(self) -> None:
         """
-        Tests that the fallback to legacy URLs works.
+        Tests that 3pe queries hit the expected URL (falling back to the
+        legacy prefix on 404) and are authenticated with the appservice's
+        token.
         """
-        SUCCESS_RESULT_USER = [
-            {
-                "protocol": PROTOCOL,
-                "userid": "@a:user",
-                "fields": {
-                    "more": "fields",
+        # Each case is (description, kind, URL -> result or exception to
+        # raise, expected URLs requested in order, expected result).
+        cases: List[
+            Tuple[
+                str,
+                str,
+                Mapping[str, Union[List[JsonDict], Exception]],
+                List[str],
+                List[JsonDict],
+            ]
+        ] = [
+            (
+                "user",
+                "user",
+                {URL_USER: SUCCESS_RESULT_USER},
+                [URL_USER],
+                SUCCESS_RESULT_USER,
+            ),
+            (
+                "location",
+                "location",
+                {URL_LOCATION: SUCCESS_RESULT_LOCATION},
+                [URL_LOCATION],
+                SUCCESS_RESULT_LOCATION,
+            ),
+            (
+                "fallback",
+                "user",
+                {
+                    URL_USER: HttpResponseException(404, "NOT_FOUND", b"NOT_FOUND"),
+                    FALLBACK_URL_USER: SUCCESS_RESULT_USER,
                 },
-            }
+                [URL_USER, FALLBACK_URL_USER],
+                SUCCESS_RESULT_USER,
+            ),
         ]
 
-        URL_USER = f"{URL}/_matrix/app/v1/thirdparty/user/{PROTOCOL}"
-        FALLBACK_URL_USER = f"{URL}/_matrix/app/unstable/thirdparty/user/{PROTOCOL}"
-
-        self.request_url = None
-        self.v1_seen = False
+        # Rebound by the loop below; the stub reads them at call time.
+        url_map: Mapping[str, Union[List[JsonDict], Exception]] = {}
+        requested_urls: List[str] = []
 
         async def get_json(
             url: str,
@@ -136,28 +177,31 @@ class ApplicationServiceApiTestCase(unittest.HomeserverTestCase):
             if not headers.get("Authorization") or not args.get(b"access_token"):
                 raise RuntimeError("Access token not provided")
 
-            self.assertEqual(headers.get("Authorization"), [f"Bearer {TOKEN}"])
+            self.assertEqual(headers.get("Authorization"), EXPECTED_AUTH_HEADER)
             self.assertEqual(args.get(b"access_token"), TOKEN)
-            self.request_url = url
-            if url == URL_USER:
-                self.v1_seen = True
-                raise HttpResponseException(404, "NOT_FOUND", b"NOT_FOUND")
-            elif url == FALLBACK_URL_USER:
-                return SUCCESS_RESULT_USER
-            else:
+            requested_urls.append(url)
+            if url not in url_map:
                 raise RuntimeError(
                     "URL provided was invalid. This should never be seen."
                 )
+            result = url_map[url]
+            if isinstance(result, Exception):
+                raise result
+            return result
 
         # We assign to a method, which mypy doesn't like.
-        self.api.get_json = Mock(side_effect=get_json)  # type: ignore[assignment]
+        self.api.get_json = get_json  # type: ignore[assignment]
 
-        result = self.get_success(
-            self.api.query_3pe(self.service, "user", PROTOCOL, {b"some": [b"field"]})
-        )
-        self.assertTrue(self.v1_seen)
-        self.assertEqual(self.request_url, FALLBACK_URL_USER)
-        self.assertEqual(result, SUCCESS_RESULT_USER)
+        for description, kind, url_map, expected_urls, expected_result in cases:
+            with self.subTest(description):
+                requested_urls.clear()
+
+                result = self._run(
+                    self.api.query_3pe(self.service, kind, PROTOCOL, QUERY_ARGS)
+                )
+
+                self.assertEqual(requested_urls, expected_urls)
+                self.assertEqual(result, expected_result)
 
     def test_claim_keys(self) -> None:
         """
@@ -165,54 +209,24 @@ class ApplicationServiceApiTestCase(unittest.HomeserverTestCase):
         keys.
         """
 
-        RESPONSE: JsonDict = {
-            "@alice:example.org": {
-                "DEVICE_1": {
-                    "signed_curve25519:AAAAHg": {
-                        # We don't really care about the content of the keys,
-                        # they get passed back transparently.
-                    },
-                    "signed_curve25519:BBBBHg": {},
-                },
-                "DEVICE_2": {"signed_curve25519:CCCCHg": {}},
-            },
-        }
-
         async def post_json_get_json(
             uri: str,
             post_json: Any,
             headers: Mapping[Union[str, bytes], Sequence[Union[str, bytes]]],
-        ) -> JsonDict:
+        ) -> Mapping[str, Any]:
             # Ensure the access token is passed as both a header and query arg.
             if not headers.get("Authorization"):
                 raise RuntimeError("Access token not provided")
 
-            self.assertEqual(headers.get("Authorization"), [f"Bearer {TOKEN}"])
-            return RESPONSE
+            self.assertEqual(headers.get("Authorization"), EXPECTED_AUTH_HEADER)
+            return CLAIM_KEYS_RESPONSE
 
         # We assign to a method, which mypy doesn't like.
-        self.api.post_json_get_json = Mock(side_effect=post_json_get_json)  # type: ignore[assignment]
-
-        MISSING_KEYS = [
-            # Known user, known device, missing algorithm.
-            ("@alice:example.org", "DEVICE_2", "xyz", 1),
-            # Known user, missing device.
-            ("@alice:example.org", "DEVICE_3", "signed_curve25519", 1),
-            # Unknown user.
-            ("@bob:example.org", "DEVICE_4", "signed_curve25519", 1),
-        ]
+        self.api.post_json_get_json = post_json_get_json  # type: ignore[assignment]
 
-        claimed_keys, missing = self.get_success(
-            self.api.claim_client_keys(
-                self.service,
-                [
-                    # Found devices
-                    ("@alice:example.org", "DEVICE_1", "signed_curve25519", 1),
-                    ("@alice:example.org", "DEVICE_2", "signed_curve25519", 1),
-                ]
-                + MISSING_KEYS,
-            )
+        claimed_keys, missing = self._run(
+            self.api.claim_client_keys(self.service, ALL_KEYS)
         )
 
-        self.assertEqual(claimed_keys, RESPONSE)
+        self.assertEqual(claimed_keys, CLAIM_KEYS_RESPONSE)
         self.assertEqual(missing, MISSING_KEYS)